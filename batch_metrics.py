@@ -27,9 +27,17 @@ class BatchMetrics:
         """
         Reduce the minibatch metrics across all processes.
         """
-        # Create a tensor from the minibatch_metrics values in the order of keys
-        keys = list(self.minibatch_metrics.keys())
-        tensor = torch.tensor([float(self.minibatch_metrics[k]) for k in keys], device=accelerator.device)
+        # Create a tensor from the minibatch_metrics values in the order of keys.
+        # Metrics that are already tensors are stacked on device; calling float() on each of them
+        # would force one host sync per key. Python floats are copied over in a single transfer.
+        device_keys = [k for k, v in self.minibatch_metrics.items() if isinstance(v, torch.Tensor)]
+        host_keys = [k for k, v in self.minibatch_metrics.items() if not isinstance(v, torch.Tensor)]
+        keys = device_keys + host_keys
+        tensor = torch.cat([
+            torch.stack([self.minibatch_metrics[k].to(device=accelerator.device, dtype=torch.float32).reshape(()) for k in device_keys])
+            if device_keys else torch.empty(0, device=accelerator.device),
+            torch.tensor([float(self.minibatch_metrics[k]) for k in host_keys], device=accelerator.device),
+        ])
         reduced_tensor = accelerator.reduce(tensor, reduction="sum")
         for key, value in zip(keys, reduced_tensor.tolist()):
             self.totals[key] += value
@@ -9,6 +9,38 @@ import sympy
 from sympy.parsing import sympy_parser
 from typing import Optional
 
+# Patterns are compiled once at import, grading runs them for every sample.
+_TEXT_WRAPPER_RE = re.compile("^\\\\text\{(?P<text>.+?)\}$")
+_FRAC_RE = re.compile(r"^-?[0-9]+.?/0*[1-9][0-9]*.?$")
+_MIXED_NUMBER_RE = re.compile("([0-9]) +([0-9])")
+_THOUSANDS_COMMA_RE = re.compile("(\d)(,)(\d\d\d)($|\D)")
+_UNIT_RES = [
+    re.compile(f"{unit}(es)?(s)? *(\^[0-9]+)?")
+    for unit in [
+        "degree",
+        "cm",
+        "centimeter",
+        "meter",
+        "mile",
+        "second",
+        "minute",
+        "hour",
+        "day",
+        "week",
+        "month",
+        "year",
+        "foot",
+        "feet",
+        "inch",
+        "yard",
+    ]
+]
+_CIRC_RE = re.compile(f"\^ *\\\\circ")
+_LATEX_COMMA_SPACE_RE = re.compile(",\\\\! *")
+_NEGATIVE_SPACE_RE = re.compile("- *")
+_BOXED_PREFIX = "\\boxed{"
+_BRACE_RE = re.compile("[{}]")
+
 
 # Dan Hendrycks' code
 def mathd_normalize_answer(answer: Optional[str]) -> Optional[str]:
@@ -17,7 +49,7 @@ def mathd_normalize_answer(answer: Optional[str]) -> Optional[str]:
     answer = answer.strip()
     try:
         # Remove enclosing `\text{}`.
-        m = re.search("^\\\\text\{(?P<text>.+?)\}$", answer)
+        m = _TEXT_WRAPPER_RE.search(answer)
         if m is not None:
             answer = m.group("text").strip()
         return _strip_string(answer)
@@ -166,7 +198,7 @@ def _strip_string(string):
 
 # sympy might hang -- we don't care about trying to be lenient in these cases
 BAD_SUBSTRINGS = ["^{", "^("]
-BAD_REGEXES = ["\^[0-9]+\^", "\^[0-9][0-9]+"]
+BAD_REGEXES = [re.compile(r) for r in ["\^[0-9]+\^", "\^[0-9][0-9]+"]]
 TUPLE_CHARS = "()[]"
 
 
@@ -216,7 +248,7 @@ def _is_int(x: float) -> bool:
 
 
 def _is_frac(expr: str) -> bool:
-    return bool(re.search(r"^-?[0-9]+.?/0*[1-9][0-9]*.?$", expr))
+    return bool(_FRAC_RE.search(expr))
 
 
 def _str_is_int(x: str) -> bool:
@@ -239,16 +271,14 @@ def _inject_implicit_mixed_number(step: str):
     Automatically make a mixed number evalable
     e.g. 7 3/4 => 7+3/4
     """
-    p1 = re.compile("([0-9]) +([0-9])")
-    step = p1.sub("\\1+\\2", step)  ## implicit mults
+    step = _MIXED_NUMBER_RE.sub("\\1+\\2", step)  ## implicit mults
     return step
 
 
 def _strip_properly_formatted_commas(expr: str):
     # We want to be careful because we don't want to strip tuple commas
-    p1 = re.compile("(\d)(,)(\d\d\d)($|\D)")
     while True:
-        next_expr = p1.sub("\\1\\3\\4", expr)
+        next_expr = _THOUSANDS_COMMA_RE.sub("\\1\\3\\4", expr)
         if next_expr == expr:
             break
         expr = next_expr
@@ -261,7 +291,7 @@ def _normalize(expr: str) -> str:
         return None
 
     # Remove enclosing `\text{}`.
-    m = re.search("^\\\\text\{(?P<text>.+?)\}$", expr)
+    m = _TEXT_WRAPPER_RE.search(expr)
     if m is not None:
         expr = m.group("text")
 
@@ -276,31 +306,14 @@ def _normalize(expr: str) -> str:
     expr = expr.replace("billion", "*10^9")
     expr = expr.replace("trillion", "*10^12")
 
-    for unit in [
-        "degree",
-        "cm",
-        "centimeter",
-        "meter",
-        "mile",
-        "second",
-        "minute",
-        "hour",
-        "day",
-        "week",
-        "month",
-        "year",
-        "foot",
-        "feet",
-        "inch",
-        "yard",
-    ]:
-        expr = re.sub(f"{unit}(es)?(s)? *(\^[0-9]+)?", "", expr)
-    expr = re.sub(f"\^ *\\\\circ", "", expr)
+    for unit_re in _UNIT_RES:
+        expr = unit_re.sub("", expr)
+    expr = _CIRC_RE.sub("", expr)
 
     if len(expr) > 0 and expr[0] == "{" and expr[-1] == "}":
         expr = expr[1:-1]
 
-    expr = re.sub(",\\\\! *", "", expr)
+    expr = _LATEX_COMMA_SPACE_RE.sub("", expr)
     if _is_float(expr) and _is_int(float(expr)):
         expr = str(int(round(float(expr))))
     if "\\" in expr:
@@ -310,7 +323,7 @@ def _normalize(expr: str) -> str:
             pass
 
     # edge case with mixed numbers and negative signs
-    expr = re.sub("- *", "-", expr)
+    expr = _NEGATIVE_SPACE_RE.sub("-", expr)
 
     expr = _inject_implicit_mixed_number(expr)
     expr = expr.replace(" ", "")
@@ -345,7 +358,7 @@ def should_allow_eval(expr: str):
             return False
 
     for bad_regex in BAD_REGEXES:
-        if re.search(bad_regex, expr) is not None:
+        if bad_regex.search(expr) is not None:
             return False
 
     return True
@@ -422,10 +435,22 @@ def remove_boxed(s):
 
 
 def extract_boxed_answer(solution: str) -> str:
-    """Extract the answer from inside a LaTeX \\boxed{} command"""
-    solution = last_boxed_only_string(solution)
-    solution = remove_boxed(solution)
-    return solution
+    """
+    Extract the answer from inside the last LaTeX \\boxed{} command.
+    Same result as remove_boxed(last_boxed_only_string(solution)), in one pass that jumps from
+    brace to brace instead of stepping through every character of the generation.
+    """
+    start = solution.rfind("\\boxed")
+    # a trailing \fbox or a \boxed without an opening brace right after it never yields an answer
+    if start < 0 or not solution.startswith(_BOXED_PREFIX, start):
+        return None
+    start += len(_BOXED_PREFIX)
+    depth = 1
+    for brace in _BRACE_RE.finditer(solution, start):
+        depth += 1 if brace.group() == "{" else -1
+        if depth == 0:
+            return solution[start:brace.start()]
+    return None
 
 def grade_answer_sympy(given_answer: str, ground_truth: str) -> bool:
     ground_truth_normalized = _normalize(ground_truth)
@@ -437,7 +462,8 @@ def grade_answer_sympy(given_answer: str, ground_truth: str) -> bool:
     if ground_truth_normalized == given_normalized:
         return True
 
-    if len(given_normalized) == 0:
+    # nothing to compare, return before tuple splitting and sympy rather than failing on len(None)
+    if not given_normalized:
         return False
 
     ground_truth_elems = split_tuple(ground_truth_normalized)
@@ -467,6 +493,9 @@ def grade_answer_sympy(given_answer: str, ground_truth: str) -> bool:
     return is_correct
 
 def grade_answer_mathd(given_answer: str, ground_truth: str) -> bool:
+    # a missing answer would otherwise "match" a ground truth that failed to normalize
+    if given_answer is None:
+        return False
     ground_truth_normalized_mathd = mathd_normalize_answer(ground_truth)
     given_answer_normalized_mathd = mathd_normalize_answer(given_answer)
 
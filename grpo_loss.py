@@ -182,6 +182,7 @@ def compute_grpo_loss(
     policy_model,
     minibatch,
     kl_coeff: float,
+    loss_scale: float = 1.0,
 ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     """
     Compute GRPO loss with its components using the PPO-style probability ratio trick.
@@ -195,6 +196,8 @@ def compute_grpo_loss(
     # average over the number of trajectories in the batch (at the gradient step level).
     # We also divide by the number of tokens (actions) in each trajectory to ensure long and short
     # trajectories contribute to the gradient equally.
+    #
+    # loss_scale multiplies the returned loss (not the metrics), e.g. by the world size to undo FSDP's mean reduction.
     """
     # torch.autograd.set_detect_anomaly(True)
     # print("\033[1;91;40mDEBUG: remove torch.autograd.set_detect_anomaly(True)\033[0m")
@@ -268,7 +271,7 @@ def compute_grpo_loss(
     pg_loss_metrics = (pg_loss.detach()/output_lens_broadcasted).sum().item()
     kl_div_metrics = (kl_div.detach()/output_lens_broadcasted).sum().item()
 
-    loss = (loss/output_lens_broadcasted).sum()
+    loss = (loss/output_lens_broadcasted).sum() * loss_scale
     # torch.distributed.breakpoint()
 
     return loss, loss_metrics, pg_loss_metrics, kl_div_metrics
@@ -6,6 +6,7 @@ import logging
 from numba import njit
 from transformers import AutoTokenizer
 import torch.distributed as dist
+from utils import GREEN, RED, HIGHLIGHT, RESET
 # Configure numba logging
 logging.getLogger("numba").setLevel(logging.WARNING)
 
@@ -87,20 +88,30 @@ def broadcast_values(values, output_lens):
 
     return broadcasted
 
+def to_device(tensor, device):
+    """
+    Move a CPU tensor to `device` without blocking the host.
+    CUDA copies are staged through pinned memory so they are truly asynchronous; they are issued
+    on the current stream, so kernels launched afterwards (e.g. the loss) are ordered behind them.
+    """
+    if torch.device(device).type == "cuda":
+        tensor = tensor.pin_memory()
+    return tensor.to(device, non_blocking=True)
+
 def get_output_logits_indices(batched_questions, device):
     input_lens = np.array([s['input_len'] for s in batched_questions])
     output_lens = np.array([s['output_len'] for s in batched_questions])
     output_indices = get_output_logits_indices_numba(input_lens, output_lens)
-    output_indices = torch.from_numpy(output_indices).to(device)
+    output_indices = to_device(torch.from_numpy(output_indices), device)
     return output_indices, output_lens
 
 def get_input_for_logprobs(batched_questions, output_indices, device):
-    batch_ids = torch.cat(
+    batch_ids = to_device(torch.cat(
         [torch.tensor(s['sample_ids'], dtype=torch.long) for s in batched_questions]
-    ).unsqueeze(0).to(device)
-    batch_position_ids = torch.cat(
+    ).unsqueeze(0), device)
+    batch_position_ids = to_device(torch.cat(
         [torch.tensor(s['sample_position_ids'], dtype=torch.long) for s in batched_questions]
-    ).unsqueeze(0).to(device)
+    ).unsqueeze(0), device)
     labels = torch.ones_like(batch_ids) * -100
     labels[:, output_indices+1] = batch_ids[:, output_indices+1]
     return batch_ids, batch_position_ids, labels
@@ -116,28 +127,28 @@ def post_process_batch(batched_questions, device, constant_length_samples=None):
             sample = random.choice(batched_questions)
         print(
             # f"\033[1;96;40mDecoded Sample:\033[0m {sample['sample_text'][:500]}\n ... \n{sample['sample_text'][-4000:]}\n" +
-            f"\033[1;96;40mDecoded Sample:\033[0m {sample['sample_text']}\n" +
-            f"\033[1;96;40mReward:\033[0m {sample['reward']}\n" +
-            f"\033[1;96;40mGround Truth Answer:\033[0m {sample['answer']}\n" +
-            (f"\033[1;96;40mParsed Ground Truth Answer:\033[0m {sample['parsed_gt_answer']}\n" if 'parsed_gt_answer' in sample else "") +
-            (f"\033[1;96;40mParsed Attempt: {sample['parsed_attempt']}\033[0m\n" if 'parsed_attempt' in sample else f"\033[1;38;5;196mFailed verification\033[0m\n")
+            f"{HIGHLIGHT}Decoded Sample:{RESET} {sample['sample_text']}\n" +
+            f"{HIGHLIGHT}Reward:{RESET} {sample['reward']}\n" +
+            f"{HIGHLIGHT}Ground Truth Answer:{RESET} {sample['answer']}\n" +
+            (f"{HIGHLIGHT}Parsed Ground Truth Answer:{RESET} {sample['parsed_gt_answer']}\n" if 'parsed_gt_answer' in sample else "") +
+            (f"{HIGHLIGHT}Parsed Attempt: {sample['parsed_attempt']}{RESET}\n" if 'parsed_attempt' in sample else f"{RED}Failed verification{RESET}\n")
         )
     advantages = np.array([s['advantage'] for s in batched_questions])
     # print("\033[1;91;40mDEBUG using sample lens (not outputlens to broadcast)\033[0m")
     sample_lens = np.array([s['input_len'] +s['output_len'] for s in batched_questions])
-    advantages = torch.from_numpy(broadcast_values(advantages, sample_lens)).to(device).to(torch.float32)
+    advantages = to_device(torch.from_numpy(broadcast_values(advantages, sample_lens)), device).to(torch.float32)
     
     if constant_length_samples is None:
-        output_lens_broadcasted = torch.from_numpy(broadcast_values(output_lens, sample_lens)).to(device).to(torch.float32)
+        output_lens_broadcasted = to_device(torch.from_numpy(broadcast_values(output_lens, sample_lens)), device).to(torch.float32)
     else:
         output_lens_broadcasted = torch.ones_like(advantages).to(device).to(torch.float32) * constant_length_samples
 
     # if any(s['sample_logprobs'] is None for s in batched_questions)\
     #       or any(torch.tensor(s['sample_logprobs']).ndim == 0 for s in batched_questions):
     #     torch.distributed.breakpoint(dist.get_rank())
-    reference_output_logprobs = torch.cat(
+    reference_output_logprobs = to_device(torch.cat(
         [torch.tensor(s['sample_logprobs']) for s in batched_questions]
-    ).to(device).to(torch.float32)
+    ), device).to(torch.float32)
 
     batch_ids, batch_position_ids, labels = get_input_for_logprobs(batched_questions, output_indices, device)
     # output_mask = torch.zeros_like(batch_ids, dtype=torch.float32, device=device)
@@ -168,7 +179,7 @@ def post_process_batch(batched_questions, device, constant_length_samples=None):
     # torch.distributed.barrier()
     # torch.distributed.breakpoint()
     # torch.distributed.barrier()
-    print(f"\033[1;32mYielding batch of length {output_lens.sum()} Rank: {os.environ['LOCAL_RANK']}\033[0m")
+    print(f"{GREEN}Yielding batch of length {output_lens.sum()} Rank: {os.environ['LOCAL_RANK']}{RESET}")
     return {
         "batch_ids": batch_ids.contiguous(),
         "batch_position_ids": batch_position_ids.contiguous(),
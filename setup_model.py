@@ -45,6 +45,8 @@ def get_fsdp_config(args, model: PreTrainedModel):
         #     buffer_dtype=torch.bfloat16,
         # ),
         backward_prefetch=BackwardPrefetch.BACKWARD_PRE,
+        # issue the next unit's all-gather before running the current unit's forward so it overlaps with compute.
+        forward_prefetch=args.fsdp_forward_prefetch,
         sharding_strategy=ShardingStrategy[args.fsdp_sharding_strategy],
         # sync_module_states=True,
         # param_init_fn=lambda module: module.to_empty(device=torch.device("cuda"), recurse=False),
@@ -1,9 +1,18 @@
 import argparse
 import asyncio
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import logging
 import os
 from pathlib import Path
+import queue
+import threading
 import time
+import uuid
 
+import numpy as np
 import torch
 import ray
 from accelerate import Accelerator
@@ -14,29 +23,102 @@ from datasets import load_dataset
 from transformers import AutoTokenizer
 from setup_model import setup_model, setup_training_components
 from grpo_loss import compute_grpo_loss
-from utils import init_distributed_environment, log_rank_0, setup_logger
+from utils import init_distributed_environment, log_rank_0, setup_logger, MAGENTA, GREEN, RED, ORANGE, CYAN, RESET
 from sample_processing_utils import post_process_batch
 from batch_metrics import BatchMetrics
 
+# dtype the inference workers load their weights in (see GenerationVLLMWorker.get_engine_args and setup_model).
+VLLM_WEIGHTS_DTYPE = torch.bfloat16
+
 
 class JsonlDataset(Dataset):
-    def __init__(self, path: str = "/new_data/aldo/v1_reasoning/math_simplerl_qwen_data_token_ids.jsonl"):
-        # The fixed token sequence to be returned for every sample.
-        # self.sequence = [
-        #     100264, 882, 100266, 4438, 1053, 499, 12849, 279, 8286, 315,
-        #     264, 6211, 1903, 315, 279, 11552, 315, 1403, 66818, 315,
-        #     279, 1890, 10801, 1405, 279, 19169, 72359, 449, 279, 7479,
-        #     315, 279, 1023, 26436, 30, 100265, 100264, 78191, 100266
-        # ]
-        # self.length = length
-        self.dataset = load_dataset("json", data_files=path, split="train")
+    """
+    Columnar view of a jsonl dataset.
+    The prompt token ids are converted once into a flat int32 array with per-sample offsets and cached
+    as .npy files, next to the jsonl or in cache_dir. Later runs memory-map the cache, so the loader workers
+    of every rank share the same pages instead of each holding a decoded copy. The cache records the size,
+    mtime and row count of the jsonl it was built from and is only used while they match; when it can't be
+    written or doesn't validate, the token ids are kept in memory instead. The remaining columns (which can
+    hold long fields like worked solutions) stay in the memory-mapped Arrow table and are only converted
+    to Python for the row being read, so forked loader workers don't copy them.
+    """
+    def __init__(self, path: str = "/new_data/aldo/v1_reasoning/math_simplerl_qwen_data_token_ids.jsonl", cache_dir: str | None = None):
+        dataset = load_dataset("json", data_files=path, split="train")
+        stat = os.stat(path)
+        source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "num_rows": len(dataset)}
+        cache_prefix = os.path.join(cache_dir or os.path.dirname(os.path.abspath(path)), os.path.basename(path))
+        cache_paths = (f"{cache_prefix}.input_token_ids.npy", f"{cache_prefix}.offsets.npy", f"{cache_prefix}.token_ids_cache.json")
+        # One process per node builds a missing or stale cache (the cache dir may be node local), the others
+        # wait for it at the barrier. Writes are atomic renames, so nodes sharing the dir can't see partial files.
+        if int(os.environ.get("LOCAL_RANK", 0)) == 0 and not self._cache_matches(cache_paths[2], source):
+            try:
+                self._write_token_ids_cache(dataset["input_token_ids"], source, *cache_paths)
+            except OSError as e:
+                logging.warning(f"Couldn't write the token id cache for {path}, keeping the token ids in memory: {e}")
+        if dist.is_initialized():
+            dist.barrier()
+        cached = self._load_token_ids_cache(source, *cache_paths)
+        if cached is None:
+            cached = self._flatten_token_ids(dataset["input_token_ids"])
+        self.input_token_ids, self.offsets = cached
+        self.other_columns = dataset.remove_columns("input_token_ids")
+        self.num_samples = source["num_rows"]
+
+    @staticmethod
+    def _flatten_token_ids(input_token_ids):
+        lengths = np.fromiter((len(ids) for ids in input_token_ids), dtype=np.int64, count=len(input_token_ids))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat_ids = np.fromiter(chain.from_iterable(input_token_ids), dtype=np.int32, count=int(offsets[-1]))
+        return flat_ids, offsets
+
+    @staticmethod
+    def _cache_matches(meta_path: str, source: dict) -> bool:
+        try:
+            with open(meta_path) as f:
+                return json.load(f) == source
+        except (OSError, ValueError):
+            return False
+
+    @classmethod
+    def _write_token_ids_cache(cls, input_token_ids, source: dict, token_ids_path: str, offsets_path: str, meta_path: str):
+        flat_ids, offsets = cls._flatten_token_ids(input_token_ids)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        # write to private files (unique across the nodes sharing the dir) and rename so no one maps a partial
+        # cache. The metadata goes last: until it's replaced, the old one doesn't match the source and the
+        # arrays aren't used.
+        for array, cache_path in ((flat_ids, token_ids_path), (offsets, offsets_path)):
+            tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp.npy"
+            np.save(tmp_path, array)
+            os.replace(tmp_path, cache_path)
+        tmp_path = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(source, f)
+        os.replace(tmp_path, meta_path)
+
+    @classmethod
+    def _load_token_ids_cache(cls, source: dict, token_ids_path: str, offsets_path: str, meta_path: str):
+        if not cls._cache_matches(meta_path, source):
+            return None
+        try:
+            flat_ids = np.load(token_ids_path, mmap_mode="r")
+            offsets = np.load(offsets_path, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            logging.warning(f"Couldn't load the token id cache {token_ids_path}, keeping the token ids in memory: {e}")
+            return None
+        if len(offsets) != source["num_rows"] + 1 or offsets[-1] != len(flat_ids):
+            logging.warning(f"Token id cache {token_ids_path} doesn't match the dataset, keeping the token ids in memory")
+            return None
+        return flat_ids, offsets
 
     def __len__(self):
-        return len(self.dataset)
+        return self.num_samples
 
     def __getitem__(self, index: int):
-        # Ignore the index and return a fresh copy of the sequence tensor.
-        return self.dataset[index]
+        sample = self.other_columns[index]
+        # vLLM and the batcher expect a plain list of token ids.
+        sample['input_token_ids'] = self.input_token_ids[self.offsets[index]:self.offsets[index + 1]].tolist()
+        return sample
     
 
 class InfiniteDistributedSampler(Sampler):
@@ -50,28 +132,37 @@ class InfiniteDistributedSampler(Sampler):
         self.seed = seed
         self.rank = dist.get_rank()
         self.world_size = dist.get_world_size()
+        # Drop any extra indices that don't divide evenly among ranks
+        self.num_usable = (len(data_source) // self.world_size) * self.world_size
 
     def __iter__(self):
         epoch = 0
         while True:
             # Use a seed that changes every epoch so that you get a new permutation each time.
-            g = torch.Generator()
-            g.manual_seed(self.seed + epoch)
-            indices = torch.randperm(len(self.data_source), generator=g).tolist()
-            
-            # Drop any extra indices that don't divide evenly among ranks
-            indices = indices[:(len(indices) - len(indices) % self.world_size)]
+            rng = np.random.default_rng(self.seed + epoch)
+            indices = rng.permutation(len(self.data_source))
             
             # Each rank gets every world_size-th index starting from its rank.
-            indices = indices[self.rank::self.world_size]
-            yield from indices
+            # Slice while still an array so only this rank's share is converted to Python ints.
+            indices = indices[self.rank:self.num_usable:self.world_size]
+            yield from indices.tolist()
             epoch += 1
 
     def __len__(self):
         return len(self.data_source) // self.world_size
 
-def get_dataloader(global_batch_size: int, path: str = "/new_data/aldo/v1_reasoning/math_simplerl_qwen_data_token_ids.jsonl", sampler_seed: int = 37):
-    dataset = JsonlDataset(path=path)
+def collate_samples(batch: list[dict]) -> list[dict]:
+    """
+    Keep the batch as a list of sample dicts: it is sent to the experience batcher and the vLLM
+    workers, which need the raw prompt text, answers and token id lists rather than padded tensors.
+    The tensors for training are built from the generated samples in post_process_batch.
+    Defined at module level (unlike a lambda) so it can be pickled for spawned loader workers.
+    """
+    return batch
+
+def get_dataloader(global_batch_size: int, path: str = "/new_data/aldo/v1_reasoning/math_simplerl_qwen_data_token_ids.jsonl", sampler_seed: int = 37,
+                   cache_dir: str | None = None):
+    dataset = JsonlDataset(path=path, cache_dir=cache_dir)
     # Compute per-device local batch size based on the global batch size and world size.
     rank = dist.get_rank()
     world_size = dist.get_world_size()
@@ -79,9 +170,17 @@ def get_dataloader(global_batch_size: int, path: str = "/new_data/aldo/v1_reason
     if rank < (global_batch_size % world_size):
         local_batch_size += 1
     sampler = InfiniteDistributedSampler(dataset, seed=sampler_seed)
-    return DataLoader(dataset, batch_size=local_batch_size, sampler=sampler, num_workers=4, collate_fn=lambda batch: batch)
-
-def update_vllm_worker_weights(model, accelerator, registry_actor_names=["reference_model_registry", "actor_model_registry"]):
+    # Batches are lists of sample dicts handed to the experience batcher, they never go to the GPU,
+    # so pinning doesn't apply here. Keep the workers alive and a few batches ahead instead.
+    return DataLoader(dataset,
+                      batch_size=local_batch_size,
+                      sampler=sampler,
+                      num_workers=4,
+                      persistent_workers=True,
+                      prefetch_factor=4,
+                      collate_fn=collate_samples)
+
+def update_vllm_worker_weights(model, accelerator, registry_actor_names=["reference_model_registry", "actor_model_registry"], timeout=None):
     """
     Update the weights on all vLLM actors using the state dict obtained from the model.
     
@@ -89,59 +188,146 @@ def update_vllm_worker_weights(model, accelerator, registry_actor_names=["refere
         model: The model whose weights should be updated on the remote actors.
         accelerator: The Accelerator instance (with accelerator.is_main_process).
         registry_actor_names: The names of the registries to update (the reference model and/or the actor models)
+        timeout: Seconds to wait for the actors to load the new weights. Actors that haven't finished by then are
+                 reported and left to finish in the background, errors from the ones that finished are raised.
+                 None waits indefinitely.
     
     Returns:
         The list of results from the update operations if on the main process; otherwise, None.
     """
     # Retrieve the state dict from the model.
     # log_rank_0(f"\033[1;32mStarting to update weights on {registry_actor_names}\033[0m")
-    print(f"\033[1;32mStarting to update weights on {registry_actor_names} Rank: {accelerator.process_index}\033[0m")
+    print(f"{GREEN}Starting to update weights on {registry_actor_names} Rank: {accelerator.process_index}{RESET}")
     start = time.time()
     state_dict = accelerator.get_state_dict(model)
     
     # Only the main process performs the update.
     if accelerator.is_main_process:
+        # The vLLM and logprob workers run in bf16, FSDP mixed precision may have upcast the master weights to fp32.
+        state_dict = {name: tensor.to(VLLM_WEIGHTS_DTYPE) if tensor.is_floating_point() else tensor
+                      for name, tensor in state_dict.items()}
         # Use ray.put to upload the state dict to the Ray object store.
         state_ref = ray.put(state_dict)
-        tasks = []
-        for registry_actor_name in registry_actor_names:
-            # Get the registry actor which maintains the inference actors.
-            registry = ray.get_actor(registry_actor_name)
-            tasks.append(registry.update_weights.remote(new_state_dict=state_ref))
-            replica_handles = ray.get(registry.get_actors.remote())
-            tasks.extend([handle.update_weights.remote(new_state_dict=state_ref)
-                        for handle in replica_handles])
-        ray.get(tasks)
-        print(f"\033[1;32mUpdated weights on {registry_actor_names} in {time.time() - start:.2f} seconds\033[0m")
-
+        # Get the registry actors which maintain the inference actors and fetch all their replica lists in one round trip.
+        registries = [ray.get_actor(registry_actor_name) for registry_actor_name in registry_actor_names]
+        replica_handles = ray.get([registry.get_actors.remote() for registry in registries])
+        # Late-joining workers fetch their initial weights from the registry, which only needs the ref.
+        tasks = [registry.update_weights.remote(new_state_dict_ref=[state_ref]) for registry in registries]
+        tasks.extend([handle.update_weights.remote(new_state_dict=state_ref)
+                      for handles in replica_handles for handle in handles])
+        ready, pending = ray.wait(tasks, num_returns=len(tasks), timeout=timeout)
+        # surface errors raised by the actors that did finish, only the stragglers are tolerated
+        ray.get(ready)
+        if pending:
+            print(f"{RED}{len(pending)} of {len(tasks)} weight updates on {registry_actor_names} didn't finish within {timeout} seconds{RESET}")
+        print(f"{GREEN}Updated weights on {registry_actor_names} in {time.time() - start:.2f} seconds{RESET}")
+
+    # Release the blocks that held the gathered full state dict; this runs once per step, not per minibatch.
+    del state_dict
     torch.distributed.barrier()
     torch.cuda.empty_cache()
 
-def save_model(args, model, accelerator, samples_seen):
+class CheckpointWriter:
+    """
+    Writes checkpoints to disk on a single background thread so training doesn't wait on the filesystem.
+    At most one write is in flight: a new submission first waits for the previous one, so a slow
+    disk can't pile up full copies of the state dict in host memory.
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint_writer")
+        self.pending = None
+
+    def wait(self):
+        if self.pending is not None:
+            # re-raises anything the write job raised
+            self.pending.result()
+            self.pending = None
+
+    def submit(self, fn, *args):
+        self.wait()
+        self.pending = self.executor.submit(fn, *args)
+
+def write_checkpoint(args, model, state_dict, output_dir, samples_seen, start):
+    """Runs on the CheckpointWriter thread, state_dict is the full (CPU) state dict gathered by save_model."""
+    model.save_pretrained(str(output_dir),
+                          state_dict=state_dict,
+                          max_shard_size="20GB",
+                          safe_serialization=True,
+    )
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    tokenizer.save_pretrained(output_dir)
+    log_rank_0(f"{CYAN}Saved model at{RESET} {samples_seen} samples in {time.time() - start:.2f} seconds")
+
+def save_model(args, model, accelerator, samples_seen, checkpoint_writer: CheckpointWriter):
     log_rank_0(f"Saving model at {samples_seen} samples")
     start = time.time()
     output_dir = Path(args.output_dir) / "hf_format" / f"samples_{samples_seen}"
-    accelerator.save_model(model,
-                           str(output_dir),
-                            max_shard_size="20GB",
-                            safe_serialization=True,
-    )
+    # gathering the full state dict is a collective, every rank has to take part before training resumes.
+    # only the serialization and the disk write are deferred to the writer thread on the main process.
+    state_dict = accelerator.get_state_dict(model)
     if accelerator.is_main_process:
-        model.module.config.to_json_file(str(output_dir / "config.json"))
-        tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
-        tokenizer.save_pretrained(output_dir)
-        log_rank_0(f"\033[1;38;2;0;255;255mSaved model at\033[0m {samples_seen} samples in {time.time() - start:.2f} seconds")
-
-async def remote_queue_batch_generator(global_rank: int,
-                                       device: torch.device,
-                                       batcher_actor_name: str = "experience_batcher",
-                                       constant_length_samples: int | None = None):
-    batcher_actor = ray.get_actor(batcher_actor_name)
-    while True:
-        batch = await batcher_actor.get_batch.remote(global_rank)
-        if batch is None:
-            break
-        yield post_process_batch(batch, device, constant_length_samples=constant_length_samples)
+        checkpoint_writer.submit(write_checkpoint, args, accelerator.unwrap_model(model), state_dict, output_dir, samples_seen, start)
+
+class BatchPrefetcher:
+    """
+    Long-lived thread that pulls this rank's batches from the experience batcher and runs post_process_batch
+    on them while the training loop is busy with the previous minibatch.
+    Batches are requested one at a time: ray doesn't guarantee execution order for async actor calls, and
+    a request reordered past the sentinel would move a batch into the next step on this rank only, leaving
+    the ranks with different numbers of FSDP forward/backward passes.
+    The thread only starts on a step's batches once that step asks for them in batches(), so no minibatch
+    sits in GPU memory between steps (e.g. during the weight sync).
+    """
+    def __init__(self, batcher_actor, global_rank: int, device: torch.device, constant_length_samples: int | None = None,
+                 max_prefetched_batches: int = 2):
+        self.batcher_actor = batcher_actor
+        self.global_rank = global_rank
+        self.device = device
+        self.constant_length_samples = constant_length_samples
+        # Bounded so the thread only runs a couple of minibatches ahead (they already live on the GPU).
+        self.batch_queue = queue.Queue(maxsize=max_prefetched_batches)
+        self.step_requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="batch_prefetcher", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            with torch.cuda.device(self.device):
+                while True:
+                    self.step_requests.get()
+                    while True:
+                        batch = ray.get(self.batcher_actor.get_batch.remote(self.global_rank))
+                        if batch is None:
+                            self.batch_queue.put(None)
+                            break
+                        self.batch_queue.put(post_process_batch(batch, self.device, constant_length_samples=self.constant_length_samples))
+        except BaseException as e:
+            self.batch_queue.put(e)
+
+    async def batches(self):
+        """Yields the current step's minibatches until the batcher's sentinel."""
+        self.step_requests.put(None)
+        while True:
+            # wait on the thread without blocking the event loop
+            minibatch = await asyncio.to_thread(self.batch_queue.get)
+            if minibatch is None:
+                return
+            if isinstance(minibatch, BaseException):
+                raise minibatch
+            yield minibatch
+
+def submit_experience_generation(args, batcher_actor, dataloader, samples_per_question):
+    """Queue rollouts for this rank's next batch of questions on the experience batcher and return the Ray ref."""
+    return batcher_actor.generate_experience.remote(
+        next(dataloader),
+        samples_per_question,
+        actor_registry="generation_vllm_registry",
+        reference_registry="logprob_vllm_registry",
+        temperature=args.temperature,
+        max_tokens=args.max_generation_tokens,
+        insert_reasoning_phrases=args.insert_reasoning_phrases,
+        timeout=1200 # 20 minutes per batch of questions or skipped. --> adjust depending on settings.
+    )
 
 def scale_model_gradients(model, total_samples_in_batch, num_samples_per_question):
     """
@@ -154,15 +340,20 @@ def scale_model_gradients(model, total_samples_in_batch, num_samples_per_questio
     """
     # the more samples per question, 
     scale_factor = 1.0 / total_samples_in_batch
+    # One multi-tensor kernel per (device, dtype) group instead of one mul_ launch per parameter.
+    # The foreach fast path needs homogeneous lists, mixed ones fall back to a per-tensor loop.
+    grads_by_device_and_dtype = defaultdict(list)
     for param in model.parameters():
         if param.grad is not None:
-            param.grad.mul_(scale_factor)
+            grads_by_device_and_dtype[(param.grad.device, param.grad.dtype)].append(param.grad)
+    for grads in grads_by_device_and_dtype.values():
+        torch._foreach_mul_(grads, scale_factor)
 
 def take_gradient_step(model, optimizer, lr_scheduler, accelerator, total_samples_accumulated, num_samples_per_question):
     """Scales gradients, applies clipping, and takes an optimization step."""
     scale_model_gradients(model, total_samples_accumulated, num_samples_per_question)
     grad_norm = accelerator.clip_grad_norm_(model.parameters(), 1.0)
-    print(f"\033[1;38;2;255;165;0mGlobal Grad Norm:\033[0m {grad_norm} \033[1;38;2;255;165;0mRank:\033[0m {accelerator.process_index}")
+    print(f"{ORANGE}Global Grad Norm:{RESET} {grad_norm} {ORANGE}Rank:{RESET} {accelerator.process_index}")
     optimizer.step()
     lr_scheduler.step()
     optimizer.zero_grad()
@@ -196,7 +387,8 @@ async def train(args,
     log_rank_0("==================================================")
     # update_vllm_worker_weights(policy_model, accelerator, registry_actor_names=["generation_vllm_registry"])
     model.train()
-    dataloader = iter(get_dataloader(args.batch_size, path=args.data_path, sampler_seed=args.infinite_sampler_seed))
+    dataloader = iter(get_dataloader(args.batch_size, path=args.data_path, sampler_seed=args.infinite_sampler_seed,
+                                     cache_dir=args.data_cache_dir))
     
     device = accelerator.device
     world_size = int(os.environ["WORLD_SIZE"])
@@ -204,7 +396,10 @@ async def train(args,
     batcher_actor = ray.get_actor(args.experience_batcher_name, namespace="test")
     total_samples_accumulated = 0
     last_saved_samples = 0
+    checkpoint_writer = CheckpointWriter()
+    batch_prefetcher = BatchPrefetcher(batcher_actor, args.global_rank, device, constant_length_samples=constant_length_samples)
     batch_totals = BatchMetrics()
+    pending_experience = None
     
     # Outermost loop: Policy iteration
     for iteration in range(num_iterations):
@@ -212,39 +407,33 @@ async def train(args,
 
         for step in range(num_batches_per_ref_model_update):
             start_time = time.time()
-            batch = next(dataloader)
-            torch.distributed.barrier()
-            await batcher_actor.generate_experience.remote(
-                batch,
-                samples_per_question,
-                actor_registry="generation_vllm_registry",
-                reference_registry="logprob_vllm_registry",
-                temperature=args.temperature,
-                max_tokens=args.max_generation_tokens,
-                insert_reasoning_phrases=args.insert_reasoning_phrases,
-                timeout=1200 # 20 minutes per batch of questions or skipped. --> adjust depending on settings.
-            )
+            if pending_experience is None:
+                pending_experience = submit_experience_generation(args, batcher_actor, dataloader, samples_per_question)
+            await pending_experience
+            pending_experience = None
+            # Rank 0 may only hand the experience over to batching once every rank has queued its rollouts.
+            # The other ranks don't need to wait for it: get_batch blocks until their first batch is dispatched.
             torch.distributed.barrier()
             if accelerator.is_main_process:
                 ray.get(batcher_actor.start_creating_batches.remote())
-            torch.distributed.barrier()
+            if args.overlap_experience_generation:
+                # Queue the next step's rollouts right away so vLLM generates them while this step trains.
+                # They must arrive after rank 0 started this step's batches, otherwise they'd be batched with this step.
+                torch.distributed.barrier()
+                pending_experience = submit_experience_generation(args, batcher_actor, dataloader, samples_per_question)
 
             # Initialize a Metrics instance for accumulating minibatch metrics
             batch_totals.reset_batch()
-            async for minibatch in remote_queue_batch_generator(args.global_rank,
-                                                                device,
-                                                                batcher_actor_name=args.experience_batcher_name,
-                                                                constant_length_samples=constant_length_samples):
+            async for minibatch in batch_prefetcher.batches():
+                # Multiply the loss by the number of GPUs to account for FSDP's mean reduction.
+                # Gradient scaling divides by the total number of samples in the batch across all GPUs.
                 loss, loss_metrics, pg_loss, kl_div = compute_grpo_loss(
                     policy_model,
                     minibatch,
                     kl_coeff,
+                    loss_scale=world_size,
                 )
-                # Multiply the loss by the number of GPUs to account for FSDP's mean reduction.
-                # Gradient scaling divides by the total number of samples in the batch across all GPUs.
-                loss *= int(os.environ["WORLD_SIZE"])
                 accelerator.backward(loss)
-                torch.cuda.empty_cache()
 
                 
                 # Accumulate metrics in the Metrics instance
@@ -274,35 +463,55 @@ async def train(args,
             grad_norm = take_gradient_step(model, optimizer, lr_scheduler, accelerator, batch_num_samples, samples_per_question)
 
             if accelerator.is_main_process:
+                num_modified_samples = bm['modified_samples']
                 print(
-                    f"\033[1;38;2;255;0;255mAverage Reward Accumulated in Batch:\033[0m {bm['reward']/batch_num_samples} \033[1;38;2;255;0;255m samples trained on:\033[0m {total_samples_accumulated}\n"
-                    f"\033[1;38;2;255;0;255mAverage Output Tokens in Batch:\033[0m {bm['output_tokens']/batch_num_samples} \033[1;38;2;255;0;255m samples trained on:\033[0m {total_samples_accumulated}\n"
-                    f"\033[1;38;2;255;0;255mAverage Loss in Batch:\033[0m {bm['loss']/batch_num_samples} \033[1;38;2;255;0;255m samples trained on:\033[0m {total_samples_accumulated}\n"
-                    f"\033[1;38;2;255;0;255mLearning Rate:\033[0m {lr_scheduler.get_last_lr()}\n"
-                    f"\033[1;38;2;255;0;255mAverage PG Loss in Batch:\033[0m {bm['pg_loss']/batch_num_samples} \033[1;38;2;255;0;255m samples trained on:\033[0m {total_samples_accumulated}\n"
-                    f"\033[1;38;2;255;0;255mAverage KL Div Accumulated in Batch:\033[0m {bm['kl_div']/batch_num_samples} \033[1;38;2;255;0;255m samples trained on:\033[0m {total_samples_accumulated}\n"
-                    f"\033[1;38;2;255;0;255mAverage Modified Reward in Batch:\033[0m {bm['modified_reward']/(bm['modified_samples']+1e-6)} \033[1;38;2;255;0;255m Num Modified Samples:\033[0m {bm['modified_samples']}\n"
-                    f"\033[1;38;2;255;0;255mAverage Delimiter Not Found in Batch:\033[0m {bm['delimiter_not_found']/(bm['modified_samples']+1e-6)}\n"
-                    f"\033[1;38;2;255;0;255mAverage Non Modified Reward in Batch:\033[0m {bm['non_modified_reward']/(batch_num_samples - bm['modified_samples'])}\n"
-                    f"\033[1;38;2;255;0;255mAverage Max Reward in Group in Batch:\033[0m {bm['max_reward_in_group']/batch_num_samples}\n"
-                    f"\033[1;38;2;255;0;255mGrad Norm:\033[0m {grad_norm} samples trained on:\033[0m {total_samples_accumulated}\n"
-                    f"\033[1;38;2;0;255;0mSamples in Current Batch:\033[0m {bm['samples']}\n"
-                    f"\033[1;38;2;255;0;255mTime taken for batch:\033[0m {time.time() - start_time:.2f} seconds\n"
+                    f"{MAGENTA}Average Reward Accumulated in Batch:{RESET} {bm['reward']/batch_num_samples} {MAGENTA} samples trained on:{RESET} {total_samples_accumulated}\n"
+                    f"{MAGENTA}Average Output Tokens in Batch:{RESET} {bm['output_tokens']/batch_num_samples} {MAGENTA} samples trained on:{RESET} {total_samples_accumulated}\n"
+                    f"{MAGENTA}Average Loss in Batch:{RESET} {bm['loss']/batch_num_samples} {MAGENTA} samples trained on:{RESET} {total_samples_accumulated}\n"
+                    f"{MAGENTA}Learning Rate:{RESET} {lr_scheduler.get_last_lr()}\n"
+                    f"{MAGENTA}Average PG Loss in Batch:{RESET} {bm['pg_loss']/batch_num_samples} {MAGENTA} samples trained on:{RESET} {total_samples_accumulated}\n"
+                    f"{MAGENTA}Average KL Div Accumulated in Batch:{RESET} {bm['kl_div']/batch_num_samples} {MAGENTA} samples trained on:{RESET} {total_samples_accumulated}\n"
+                    f"{MAGENTA}Average Modified Reward in Batch:{RESET} {bm['modified_reward']/(num_modified_samples+1e-6)} {MAGENTA} Num Modified Samples:{RESET} {num_modified_samples}\n"
+                    f"{MAGENTA}Average Delimiter Not Found in Batch:{RESET} {bm['delimiter_not_found']/(num_modified_samples+1e-6)}\n"
+                    f"{MAGENTA}Average Non Modified Reward in Batch:{RESET} {bm['non_modified_reward']/(batch_num_samples - num_modified_samples)}\n"
+                    f"{MAGENTA}Average Max Reward in Group in Batch:{RESET} {bm['max_reward_in_group']/batch_num_samples}\n"
+                    f"{MAGENTA}Grad Norm:{RESET} {grad_norm} samples trained on:{RESET} {total_samples_accumulated}\n"
+                    f"{GREEN}Samples in Current Batch:{RESET} {bm['samples']}\n"
+                    f"{MAGENTA}Time taken for batch:{RESET} {time.time() - start_time:.2f} seconds\n"
                 )
 
             if total_samples_accumulated >= (args.min_samples_per_checkpoint + last_saved_samples):
-                save_model(args, model, accelerator, total_samples_accumulated)
+                save_model(args, model, accelerator, total_samples_accumulated, checkpoint_writer)
                 last_saved_samples = total_samples_accumulated
             
             #update both logprob and generation workers at the last step of the ref model update loop
-            registry_actor_names = ["generation_vllm_registry", "logprob_vllm_registry"] if step == num_batches_per_ref_model_update - 1 else ["generation_vllm_registry"]
-            update_vllm_worker_weights(policy_model, accelerator, registry_actor_names=registry_actor_names)
+            #otherwise only refresh the generation workers every update_vllm_every_n_steps steps
+            if step == num_batches_per_ref_model_update - 1:
+                registry_actor_names = ["generation_vllm_registry", "logprob_vllm_registry"]
+            elif (step + 1) % args.update_vllm_every_n_steps == 0:
+                registry_actor_names = ["generation_vllm_registry"]
+            else:
+                registry_actor_names = []
+            if registry_actor_names and pending_experience is not None:
+                # Hold the update until the overlapped round is done, so none of its rollouts or reference
+                # logprobs mix the weights before and after it. Every rank must have queued its share first.
+                await pending_experience
+                torch.distributed.barrier()
+                await batcher_actor.wait_for_queued_experience.remote()
+            if registry_actor_names:
+                update_vllm_worker_weights(policy_model, accelerator, registry_actor_names=registry_actor_names,
+                                           timeout=args.vllm_weight_update_timeout if args.vllm_weight_update_timeout > 0 else None)
         
         # update_vllm_worker_weights(policy_model, accelerator, registry_actor_names=["logprob_vllm_registry"])
+
+    # don't exit with the last checkpoint half written
+    checkpoint_writer.wait()
             
 
 
 if __name__ == "__main__":
+    # Let the caching allocator grow segments instead of fragmenting, rather than emptying the cache every minibatch.
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
     setup_logger()
     parser = argparse.ArgumentParser()
 
@@ -360,6 +569,13 @@ if __name__ == "__main__":
         help="Sharding strategy for Fully Sharded Data Parallel."
     )
 
+    parser.add_argument(
+        "--no_fsdp_forward_prefetch",
+        dest="fsdp_forward_prefetch",
+        action="store_false",
+        help="Disable FSDP forward prefetching of the next unit's all-gather (enabled by default)."
+    )
+
     parser.add_argument(
         "--experience_batcher_name",
         type=str,
@@ -406,6 +622,31 @@ if __name__ == "__main__":
         help="Enable rewriting to insert reasoning phrases during inference."
     )
 
+    parser.add_argument(
+        "--overlap_experience_generation",
+        action="store_true",
+        default=False,
+        help="Queue the next step's rollouts as soon as the current step's batches start being created, so generation "
+             "overlaps with training. Those rollouts are sampled from weights that are one update behind: "
+             "vLLM weight updates wait for the in-flight round to finish before they are pushed."
+    )
+
+    parser.add_argument(
+        "--update_vllm_every_n_steps",
+        type=int,
+        default=1,
+        help="Push the policy weights to the generation workers every n gradient steps. The reference (logprob) workers "
+             "are always updated at the end of each reference model update loop, together with the generation workers."
+    )
+
+    parser.add_argument(
+        "--vllm_weight_update_timeout",
+        type=float,
+        default=0,
+        help="Seconds to wait for the vLLM workers to load new weights before moving on without the stragglers. "
+             "The default (<= 0) waits until every worker is done."
+    )
+
     parser.add_argument(
         "--data_path",
         type=str,
@@ -417,6 +658,12 @@ if __name__ == "__main__":
         default="/new_data/aldo/v1_reasoning/grpo_feb_24th/deepscaler_phi_mini_nemotron.jsonl",
         help="Path to the data file."
     )
+    parser.add_argument(
+        "--data_cache_dir",
+        type=str,
+        default=None,
+        help="Writable directory for the token id cache of the data file. Defaults to the data file's directory."
+    )
 
     parser.add_argument(
         "--min_samples_per_checkpoint",
@@ -454,6 +701,8 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
+    if args.update_vllm_every_n_steps < 1:
+        parser.error("--update_vllm_every_n_steps must be at least 1")
     init_distributed_environment(args)
     model = setup_model(args)
     model, accelerator, optimizer, lr_scheduler = setup_training_components(args, model)
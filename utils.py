@@ -2,6 +2,7 @@ import importlib
 import os
 import logging
 import inspect
+import sys
 from datetime import timedelta
 from typing import Any
 
@@ -9,6 +10,15 @@ from rich.logging import RichHandler
 import torch
 from torch.distributed import get_rank, is_initialized
 
+# ANSI colors only make sense on a terminal, training output is usually tee'd into a log file.
+USE_COLOR = sys.stdout.isatty()
+MAGENTA = "\033[1;38;2;255;0;255m" if USE_COLOR else ""
+GREEN = "\033[1;38;2;0;255;0m" if USE_COLOR else ""
+RED = "\033[1;38;5;196m" if USE_COLOR else ""
+ORANGE = "\033[1;38;2;255;165;0m" if USE_COLOR else ""
+CYAN = "\033[1;38;2;0;255;255m" if USE_COLOR else ""
+HIGHLIGHT = "\033[1;96;40m" if USE_COLOR else ""
+RESET = "\033[0m" if USE_COLOR else ""
 
 def init_distributed_environment(args):
     from vllm_experience_batcher import get_or_create_experience_batcher
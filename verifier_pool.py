@@ -1,25 +1,29 @@
-from copy import deepcopy
 import json
 import logging
+import math
 from pathlib import Path
-import random
-import shutil
-import time
 import uuid
 import asyncio
 from functools import partial
 
 import ray
-from filelock import FileLock, Timeout
 from wrapt_timeout_decorator import timeout
 from deepscaler_math_utils import extract_answer, grade_answer_mathd, grade_answer_sympy
 from utils import patch_target_module
-from functools import partial
 patch_target_module("math_verify.utils.timeout", partial(timeout, use_signals=False))
 
 import numpy as np
 logging.getLogger().setLevel(logging.DEBUG)
 
+# seconds a sample gets to be graded before it's given up on
+VERIFY_TIMEOUT_PER_SAMPLE = 30
+# CPUs Ray reserves for each verifier worker. Fractional so that the workers, idle most of the time between
+# rollouts, don't each hold a whole CPU: more of them fit per node and SPREAD still balances them across nodes.
+DEFAULT_VERIFIER_NUM_CPUS = 0.25
+# sympy can hang on some answers. The grade runs in a subprocess that is killed after the timeout,
+# so a single sample can't hold its worker, and the rest of its batch, indefinitely.
+grade_answer_sympy_with_timeout = timeout(VERIFY_TIMEOUT_PER_SAMPLE, use_signals=False)(grade_answer_sympy)
+
 
 def cos_fn(t, T, eta_min, eta_max):
     """Basic cosine function component"""
@@ -65,7 +69,14 @@ class VerifierWorker:
 
     def extract_reference_and_answer(self, sample: dict):
         original_input = sample['input']
-        output = sample['sample_text'].split(original_input)[1]
+        sample_text = sample['sample_text']
+        # same slice as sample_text.split(original_input)[1] without splitting the whole generation
+        start = sample_text.find(original_input)
+        if start < 0:
+            raise ValueError("Sample text doesn't contain the prompt")
+        start += len(original_input)
+        end = sample_text.find(original_input, start)
+        output = sample_text[start:end if end >= 0 else None]
         if "\\boxed" in sample['answer']:
             sample['parsed_gt_answer'] = extract_answer(sample['answer'])
         else:
@@ -77,51 +88,79 @@ class VerifierWorker:
         return sample
     
     def verify_both(self, sample: dict, max_gen_length: int):
-        sample = self.extract_reference_and_answer(sample)
-        sample['original_reward'] = grade_answer_mathd(sample['parsed_attempt'], sample['parsed_gt_answer']) or grade_answer_sympy(sample['parsed_attempt'], sample['parsed_gt_answer'])
-        # TODO: Add cosine reward
-        sample['reward'] = sample['original_reward']
-        return sample
-    
-    def verify_mathd(self, sample: dict, max_gen_length: int):
-        sample = self.extract_reference_and_answer(sample)
+        """Grades with mathd first and falls back to sympy only if mathd didn't accept the extracted answer."""
+        sample = self._grade_mathd(self.extract_reference_and_answer(sample))
+        if self._needs_sympy(sample):
+            sample = self._grade_sympy(sample)
+        return self._set_reward(sample)
+
+    def verify_batch(self, samples: list[dict], max_gen_lengths: list[int]) -> list:
+        """
+        verify_both over several samples in one actor call, one sample at a time.
+        A sample that raises (e.g. its sympy grade timed out) is returned as the repr of its exception instead
+        of failing the rest of the batch: exception objects may not unpickle on the pool's side.
+        """
+        results = []
+        for sample, max_gen_length in zip(samples, max_gen_lengths):
+            try:
+                results.append(self.verify_both(sample, max_gen_length))
+            except Exception as e:
+                results.append(repr(e))
+        return results
+
+    @staticmethod
+    def _grade_mathd(sample: dict) -> dict:
+        if not sample['parsed_attempt']:
+            sample['original_reward'] = False
+            return sample
         sample['original_reward'] = grade_answer_mathd(sample['parsed_attempt'], sample['parsed_gt_answer'])
-        sample['reward'] = sample['original_reward']
-        # sample['reward'] = compute_cosine_reward(sample['output_len'], 
-        #                                          max_gen_length, 
-        #                                          format_quality=sample['parsed_attempt'] != '', 
-        #                                          is_correct=sample['original_reward'])
         return sample
-    
-    def verify_sympy(self, sample: dict, max_gen_length: int):
-        sample = self.extract_reference_and_answer(sample)
-        sample['original_reward'] = grade_answer_sympy(sample['parsed_attempt'], sample['parsed_gt_answer'])
+
+    @staticmethod
+    def _grade_sympy(sample: dict) -> dict:
+        sample['original_reward'] = grade_answer_sympy_with_timeout(sample['parsed_attempt'], sample['parsed_gt_answer'])
+        return sample
+
+    @staticmethod
+    def _needs_sympy(sample: dict) -> bool:
+        return bool(sample['parsed_attempt']) and not sample['original_reward']
+
+    @staticmethod
+    def _set_reward(sample: dict) -> dict:
+        # TODO: Add cosine reward
         sample['reward'] = sample['original_reward']
-        # sample['reward'] = compute_cosine_reward(sample['output_len'], 
-        #                                          max_gen_length, 
-        #                                          format_quality=sample['parsed_attempt'] != '', 
-        #                                          is_correct=sample['original_reward'])
         return sample
 
 @ray.remote
 class VerifierPool:
-    def __init__(self, global_num_verifiers: int, write_failed: bool = False, output_dir: str = None):
+    def __init__(self, global_num_verifiers: int, write_failed: bool = False, output_dir: str = None,
+                 verify_batch_size: int = 16, verifier_num_cpus: float = DEFAULT_VERIFIER_NUM_CPUS):
         self.node_id = ray.get_runtime_context().get_node_id()
         self.global_num_verifiers = global_num_verifiers
+        self.verifier_num_cpus = verifier_num_cpus
         self.write_failed = write_failed
         self.lock = asyncio.Lock()
+        # Samples waiting to be sent to a worker, as (sample, max_gen_length, future) tuples.
+        # They are only batched, up to verify_batch_size per call, when there are more of them than idle workers.
+        self.verify_batch_size = verify_batch_size
+        self.pending_verifications = asyncio.Queue()
+        self.batching_task = None
+        # Tasks the pool spawned and doesn't await, referenced until they finish so they aren't garbage collected.
+        self.background_tasks = set()
         # Create an asyncio.Queue to hold available workers.
         self.verifier_queue = asyncio.Queue()
         for _ in range(global_num_verifiers):
             self.create_verifier_worker()
         self.outfile = Path(output_dir) / "failed_samples_verify.jsonl" if output_dir is not None else Path("failed_samples_verify.jsonl")
         self.outfile.unlink(missing_ok=True)
-        Path(str(self.outfile) + '.lock').unlink(missing_ok=True)
+        # Failed samples are appended by a single writer task, the pool is the only process writing the file.
+        self.failed_samples_queue = asyncio.Queue()
+        self.failed_samples_writer = None
         
     def create_verifier_worker(self):
         # Create a new worker instance.
         worker = VerifierWorker.options(
-            num_cpus=1, 
+            num_cpus=self.verifier_num_cpus,
             scheduling_strategy="SPREAD"
         ).remote(f"verifier_worker_{str(uuid.uuid4())}")
         self.verifier_queue.put_nowait(worker)
@@ -130,14 +169,36 @@ class VerifierPool:
     async def write_failed_sample(self, sample: dict):
         print("\033[38;5;196m\033[1m DEBUG: Failed to verify sample \033[0m", flush=True)
         if self.write_failed:
-            try:
-                with FileLock(f"{self.outfile}.lock", timeout=20):
-                    with open(self.outfile, "a") as f:
-                        f.write(json.dumps(sample) + "\n")
-            except Timeout:
-                print("Lock acquisition failed after 20 seconds", flush=True)
+            # (re)start the writer, a failed one has been logged by _background_task_done
+            if self.failed_samples_writer is None or self.failed_samples_writer.done():
+                self.failed_samples_writer = self._create_background_task(self._write_failed_samples())
+            self.failed_samples_queue.put_nowait(sample)
         return sample
+
+    async def _write_failed_samples(self):
+        with open(self.outfile, "a") as f:
+            while True:
+                sample = await self.failed_samples_queue.get()
+                try:
+                    f.write(json.dumps(sample) + "\n")
+                except (TypeError, ValueError) as e:
+                    # one record that doesn't serialize mustn't stop the writer
+                    logging.error(f"Couldn't serialize a failed sample for {self.outfile}: {e!r}")
+                # flush once the backlog is written rather than after every sample
+                if self.failed_samples_queue.empty():
+                    f.flush()
     
+    def _create_background_task(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self._background_task_done)
+        return task
+
+    def _background_task_done(self, task: asyncio.Task):
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Verifier pool task {task.get_name()} failed: {task.exception()!r}")
+
     async def _verify_single(self, sample: dict, mode: str, **kwargs) -> dict:
         # Get a worker from the queue. If none available, create one.
         worker = await self.verifier_queue.get()
@@ -145,7 +206,8 @@ class VerifierPool:
             # Dynamically call the required verification method.
             method = getattr(worker, f"verify_{mode}")
             result_ref = method.remote(sample, kwargs['max_gen_length'])
-            result = await asyncio.wait_for(result_ref, 30)
+            # same margin over the in-worker sympy timeout as _verify_batch gives a batch of one
+            result = await asyncio.wait_for(result_ref, 2 * VERIFY_TIMEOUT_PER_SAMPLE)
         except Exception as e:
             # Replace the worker on failure.
             ray.kill(worker)
@@ -156,42 +218,85 @@ class VerifierPool:
         self.verifier_queue.put_nowait(worker)
         return result
     
-    async def pick_verified_sample(self, results: list[dict]) -> dict:
-        # Choose the result with the highest reward or non '' parsed_attempt
-        for result in results:
-            if result['original_reward'] > 0:
-                return result
-        for result in results:
-            if result['parsed_attempt'] != '':
-                return result
-        return results[0]
+    async def _dispatch_verification_batches(self):
+        """
+        Hands the pending samples to workers as they free up. While there are idle workers each sample gets
+        its own, so the samples of a GRPO group are graded in parallel. Only the backlog the idle workers
+        can't absorb is batched, ceil(pending / idle workers) samples per call.
+        """
+        while True:
+            batch = [await self.pending_verifications.get()]
+            worker = await self.verifier_queue.get()
+            batch_size = min(self.verify_batch_size,
+                             math.ceil((self.pending_verifications.qsize() + 1) / (self.verifier_queue.qsize() + 1)))
+            while len(batch) < batch_size and not self.pending_verifications.empty():
+                batch.append(self.pending_verifications.get_nowait())
+            self._create_background_task(self._verify_batch(worker, batch))
+
+    async def _verify_batch(self, worker, batch: list[tuple]):
+        samples, max_gen_lengths, futures = zip(*batch)
+        try:
+            # Each sympy grade is already cut off inside the worker, this only catches a worker that hung or died.
+            results = await asyncio.wait_for(worker.verify_batch.remote(list(samples), list(max_gen_lengths)),
+                                             VERIFY_TIMEOUT_PER_SAMPLE * (len(batch) + 1))
+        except Exception as e:
+            # Replace the worker, then give every sample of the batch its own attempt
+            # so a single bad sample doesn't fail the others.
+            ray.kill(worker)
+            self.create_verifier_worker()
+            if len(batch) == 1:
+                if not futures[0].done():
+                    futures[0].set_exception(e)
+                return
+            for sample, max_gen_length, future in batch:
+                self._create_background_task(self._retry_single(sample, max_gen_length, future))
+            return
+        self.verifier_queue.put_nowait(worker)
+        for future, result in zip(futures, results):
+            if future.done():
+                # the caller went away
+                continue
+            if isinstance(result, str):
+                # verify_batch returns the repr of what a sample raised
+                future.set_exception(RuntimeError(result))
+            else:
+                future.set_result(result)
+
+    async def _retry_single(self, sample: dict, max_gen_length: int, future: asyncio.Future):
+        try:
+            result = await self._verify_single(sample, 'both', max_gen_length=max_gen_length)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
 
     async def verify_balanced(self, sample: dict, **kwargs) -> dict:
-        # Run both mathd and sympy verification tasks concurrently
+        # Grade with mathd and then sympy inside a single worker call: verify_both only falls back to
+        # sympy when mathd doesn't match. Requests are only batched while every worker is busy.
         sample['original_reward'] = 0.0
         sample['reward'] = 0.0
         sample['parsed_attempt'] = ''
-        tasks = [
-            asyncio.create_task(self._verify_single(deepcopy(sample), 'mathd', **kwargs)),
-            asyncio.create_task(self._verify_single(deepcopy(sample), 'sympy', **kwargs))
-        ]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        valid_results = []
-        for res in results:
-            if isinstance(res, Exception):
-                continue
-            valid_results.append(res)
-        if not valid_results:
+        if self.batching_task is None:
+            self.batching_task = self._create_background_task(self._dispatch_verification_batches())
+        future = asyncio.get_running_loop().create_future()
+        # workers get a serialized copy, so on failure sample still holds the defaults above
+        self.pending_verifications.put_nowait((sample, kwargs['max_gen_length'], future))
+        try:
+            return await future
+        except Exception:
             await self.write_failed_sample(sample)
             return sample
-        
-        return await self.pick_verified_sample(valid_results)
 
 
-def get_or_create_verifier_pool(global_num_verifiers: int, write_failed: bool = False) -> VerifierPool:
-    # For simplicity, always create a new instance. In a production setting, you might want to implement a singleton.
-    try:
-        return VerifierPool.options(name="verifier_pool").remote(global_num_verifiers, write_failed) 
-    except Exception as e:
-        return ray.get_actor("verifier_pool")
+# handle of the pool for this process, only the first call has to go through the GCS
+_verifier_pool = None
+
+def get_or_create_verifier_pool(global_num_verifiers: int, write_failed: bool = False, verifier_num_cpus: float = DEFAULT_VERIFIER_NUM_CPUS) -> VerifierPool:
+    global _verifier_pool
+    if _verifier_pool is None:
+        # get_if_exists makes the lookup-or-create atomic on the GCS, concurrent callers all get the same pool.
+        _verifier_pool = VerifierPool.options(name="verifier_pool", get_if_exists=True).remote(global_num_verifiers, write_failed,
+                                                                                               verifier_num_cpus=verifier_num_cpus)
+    return _verifier_pool
@@ -1,4 +1,5 @@
 import asyncio
+import heapq
 import os
 import time
 import logging
@@ -39,39 +40,58 @@ class ExperienceBatcher:
         self.training_processes_queues = {}
         self.training_batches = {}
         self.training_batches_lengths = {}
+        # (tokens in batch, global_rank) min-heap mirroring training_batches_lengths, so picking the least
+        # full batch for every incoming sample doesn't scan all ranks.
+        self.training_batches_heap = []
         self.experience_queue = []
         self.ready_experience_samples = []
         self.actor_registry_handle = ray.get_actor("generation_vllm_registry")
         self.reference_registry_handle = ray.get_actor("logprob_vllm_registry")
         self.lock = asyncio.Lock()
+        self.batching_lock = asyncio.Lock()
     
     def start_creating_batches(self):
-        asyncio.create_task(self._create_batches())
+        # Take the experience submitted so far. Anything queued after this call (e.g. the next step's rollouts
+        # when the trainer overlaps generation with training) goes into the next round of batches.
+        experience_queue, self.experience_queue = self.experience_queue, []
+        asyncio.create_task(self._create_batches(experience_queue))
 
+    async def wait_for_queued_experience(self):
+        """Waits until the rollouts queued for the next round, reference logprobs included, are done."""
+        if self.experience_queue:
+            await asyncio.wait(list(self.experience_queue))
 
     def register_training_process(self, global_rank: int, max_tokens_per_gpu: int):
         self.max_tokens_per_gpu = max_tokens_per_gpu
         self.training_processes_queues[global_rank] = asyncio.Queue()
         self.training_batches[global_rank] = []
         self.training_batches_lengths[global_rank] = 0
+        self.rebuild_batches_heap()
         return self.training_processes_queues[global_rank]
+
+    def rebuild_batches_heap(self):
+        self.training_batches_heap = [(length, batch_id) for batch_id, length in self.training_batches_lengths.items()]
+        heapq.heapify(self.training_batches_heap)
     
 
     async def add_sample_to_batches(self, sample):
         sample_len = sample['input_len'] + sample['output_len']
-        least_full_batch_id = min(self.training_batches_lengths, key=self.training_batches_lengths.get)
-        if self.training_batches_lengths[least_full_batch_id] + sample_len > self.max_tokens_per_gpu:
+        least_full_length, least_full_batch_id = self.training_batches_heap[0]
+        if least_full_length + sample_len > self.max_tokens_per_gpu:
         #   or all(len(batch) > 1 for batch in self.training_batches.values()):
             dispatched = await self.dispatch_batches()
             if not dispatched:
                 raise Exception("Didn't dispatch but can't add sample to batch because it exceeds max tokens per gpu")
+            least_full_length, least_full_batch_id = self.training_batches_heap[0]
         self.training_batches[least_full_batch_id].append(sample)
-        self.training_batches_lengths[least_full_batch_id] += sample['input_len'] + sample['output_len']
+        self.training_batches_lengths[least_full_batch_id] += sample_len
+        heapq.heapreplace(self.training_batches_heap, (least_full_length + sample_len, least_full_batch_id))
     
     async def reset_batches(self):
         for batch_id in self.training_batches:
             self.training_batches[batch_id] = []
             self.training_batches_lengths[batch_id] = 0
+        self.rebuild_batches_heap()
     
     async def dispatch_batches(self):
         if all(len(batch) > 0 for batch in self.training_batches.values()):
@@ -87,18 +107,18 @@ class ExperienceBatcher:
         for queue in self.training_processes_queues.values():
             await queue.put(None)
 
-    async def _create_batches(self):
-        """Continuously consumes tasks from the experience_queue and processes them."""
-        async with self.lock:
-            for task in asyncio.as_completed(self.experience_queue):
-                logging.debug(f"\033[1;38;2;255;165;0mExperience queue length in _create_batches: {len(self.experience_queue)}\033[0m")
+    async def _create_batches(self, experience_queue):
+        """Consumes the tasks of one round of experience and dispatches them as batches, followed by the sentinel."""
+        # Rounds are dispatched one after another so that each training step only sees its own batches.
+        async with self.batching_lock:
+            for task in asyncio.as_completed(experience_queue):
+                logging.debug(f"\033[1;38;2;255;165;0mExperience queue length in _create_batches: {len(experience_queue)}\033[0m")
                 samples = await task
                 if samples is None: # underlying coroutine timed out
                     continue
                 for sample in samples:
                     await self.add_sample_to_batches(sample)
-            logging.debug(f"\033[1;38;2;255;165;0mExperience queue length in _create_batches after processing: {len(self.experience_queue)}\033[0m")
-            self.experience_queue = []
+            logging.debug(f"\033[1;38;2;255;165;0mExperience queue length in _create_batches after processing: {len(experience_queue)}\033[0m")
         
             await self.dispatch_batches()
             logging.debug(f"\033[1;38;2;255;165;0mLast batch dispatched\033[0m")
@@ -173,17 +193,15 @@ class ExperienceBatcher:
             return None
 
 def get_or_create_experience_batcher(experience_batcher_name: str):
-    try:
-        return ExperienceBatcher.options(
-            name=experience_batcher_name,
-            num_cpus=8,
-            namespace="test",
-            runtime_env={"env_vars": dict(os.environ),
-                        "pip": [f"-r {os.path.join(os.path.dirname(__file__), 'requirements_fsdp.txt')}"]
-                        }
-        ).remote()
-    except Exception:
-        return ray.get_actor(experience_batcher_name, namespace="test")
+    return ExperienceBatcher.options(
+        name=experience_batcher_name,
+        num_cpus=8,
+        namespace="test",
+        get_if_exists=True,
+        runtime_env={"env_vars": dict(os.environ),
+                    "pip": [f"-r {os.path.join(os.path.dirname(__file__), 'requirements_fsdp.txt')}"]
+                    }
+    ).remote()
     
 
 if __name__ == "__main__":
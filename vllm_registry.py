@@ -49,9 +49,13 @@ class VLLMRegistry:
     def get_last_weights(self):
         return self.last_weights
     
-    def update_weights(self, new_state_dict: dict):
-        '''directly put the new state in ray object storage to decrease latency'''
-        self.last_weights = ray.put(new_state_dict)
+    def update_weights(self, new_state_dict_ref: list):
+        '''keep a reference to the state dict the trainer already put in ray object storage.
+           The ref comes wrapped in a list so ray doesn't resolve it: resolving it would deserialize
+           the full model here only to ray.put a second copy of it.
+           The object stays owned by the trainer process that put it and is lost if that trainer exits,
+           so workers treat a failed fetch of last_weights as "no weights synced yet".'''
+        self.last_weights = new_state_dict_ref[0]
 
     def get_actors(self):
         return [ray.get_actor(name, namespace="test") for name in self.actors.values()]
@@ -102,10 +106,7 @@ def get_or_create_registry(registry_actor_name: str) -> VLLMRegistry:
     Retrieve the registry actor by its name. If it does not exist,
     create a new VLLMRegistry actor with the given name.
     """
-    try:
-        return VLLMRegistry.options(name=registry_actor_name).remote()
-    except Exception:
-        return ray.get_actor(registry_actor_name)
+    return VLLMRegistry.options(name=registry_actor_name, get_if_exists=True).remote()
         
 
 
@@ -1,5 +1,4 @@
 import argparse
-from copy import deepcopy
 from functools import partial
 from hashlib import sha256
 import json
@@ -96,7 +95,9 @@ def insert_phrase(response, delimiter, special_phrases, eos_str):
 
 async def rewrite_with_insert_phrase(sample, tokenizer):
     full_text = sample['sample_text']
-    original_output = full_text.split(sample['input'])[-1]
+    # the text after the last occurrence of the prompt, like full_text.split(sample['input'])[-1]
+    prompt_end = full_text.rfind(sample['input'])
+    original_output = full_text[prompt_end + len(sample['input']):] if prompt_end >= 0 else full_text
     modified_output, delimiter_not_found = insert_phrase(original_output, delimiter, special_phrases, tokenizer.eos_token)
     sample['input'] = sample['input'] + modified_output
     sample['input_token_ids'] = tokenizer.encode(sample['input'])
@@ -151,6 +152,11 @@ class BaseVLLMWorker:
             last_weights = ray.get(ray.get(self.registry.get_last_weights.remote()))
             if last_weights is not None:
                 self.update_weights(last_weights)
+        except Exception as e:
+            # The ref is owned by the trainer that synced it (see VLLMRegistry.update_weights) and is lost once
+            # that trainer exits or restarts. Serve the initial weights until the next sync instead of not registering.
+            print(f"Couldn't load the last synced weights on worker {self.worker_id}, keeping the initial weights: {e}")
+        try:
             ray.get(self.registry.register.remote(service_id=self.worker_id, max_load=self.engine_args.max_num_seqs+self.overhead_seqs))
             print(f"Worker {self.worker_id} registered.")
         except Exception as e:
@@ -244,7 +250,8 @@ class GenerationVLLMWorker(BaseVLLMWorker):
         if 'input_len' not in sample:
             sample['input_len'] = len(sample['input_token_ids'])
         
-        samples = [deepcopy(sample) for _ in range(len(request_out.outputs))]
+        # every field set below is reassigned rather than mutated, so shallow copies are enough
+        samples = [dict(sample) for _ in range(len(request_out.outputs))]
         
         sample_rewards_futures = []
         for sample, out in zip(samples, request_out.outputs):
@@ -265,7 +272,7 @@ class GenerationVLLMWorker(BaseVLLMWorker):
         logging.debug(f"\033[1;38;2;255;165;0mFirst sample before rewriting: \033[0m {samples[0]['sample_text']}")
 
         if insert_reasoning_phrases:
-            modified_samples = [deepcopy(sample) for sample in samples]
+            modified_samples = [dict(sample) for sample in samples]
             modified_samples = await asyncio.gather(*[rewrite_with_insert_phrase(sample, self.tokenizer) for sample in modified_samples])
             logging.debug(f"\033[1;38;2;255;165;0mFirst sample after rewriting: \033[0m {modified_samples[0]['input']}")
             
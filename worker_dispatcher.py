@@ -12,7 +12,7 @@ import time
 import uuid
 import ray
 
-from verifier_pool import get_or_create_verifier_pool
+from verifier_pool import get_or_create_verifier_pool, DEFAULT_VERIFIER_NUM_CPUS
 from vllm_registry import get_or_create_registry
 
 
@@ -90,6 +90,8 @@ if __name__ == "__main__":
                         help="Maximum tokens per GPU for logprob worker")
     parser.add_argument("--global_num_verifiers", type=int, default=100,
                         help="Number of verifier workers for the global verifier pool")
+    parser.add_argument("--verifier_num_cpus", type=float, default=DEFAULT_VERIFIER_NUM_CPUS,
+                        help="CPUs Ray reserves for each verifier worker, fractional values pack several workers per CPU")
     parser.add_argument("--write_failed_generation_samples", action="store_true",
                         help="If set, writing failed generation samples to file will be enabled. Do this only on a single node. Clusters with s3fs will corrupt the file.")
     parser.add_argument("--overhead_seqs", type=int, default=8,
@@ -105,7 +107,7 @@ if __name__ == "__main__":
 
     verifier_pool = None
     if args.mode == "generation":
-        verifier_pool = get_or_create_verifier_pool(args.global_num_verifiers)
+        verifier_pool = get_or_create_verifier_pool(args.global_num_verifiers, verifier_num_cpus=args.verifier_num_cpus)
 
     print(f"Launching {args.mode} worker ...")
     